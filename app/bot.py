@@ -1,10 +1,11 @@
 import os
 import re
+import time
 import asyncio
 import tempfile
 import zipfile
-from io import BytesIO
-from typing import List, Optional, Tuple
+from datetime import timedelta
+from typing import List, Optional
 
 from dotenv import load_dotenv
 from telegram import (
@@ -20,7 +21,7 @@ from telegram import (
     CallbackQuery,
     InputFile,
 )
-from telegram.constants import ParseMode
+from telegram.constants import MediaGroupLimit, MessageLimit, ParseMode
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -43,6 +44,12 @@ if not BOT_TOKEN or ":" not in BOT_TOKEN:
 
 LOR_TARGET_CHAT_ID = int(os.getenv("LOR_TARGET_CHAT_ID", "0"))
 MAX_ZIP_MB = int(os.getenv("MAX_ZIP_MB", "47"))
+SEND_ZIP = os.getenv("SEND_ZIP", "0") == "1"
+CAPTION_LIMIT = 1024
+ZIP_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+DOWNLOAD_CONCURRENCY = 6
+MEDIA_GROUP_CONCURRENCY = 3
+DRAFT_FLUSH_DELAY = 0.5
 
 MAIN_KB = ReplyKeyboardMarkup(
     [
@@ -55,10 +62,15 @@ MAIN_KB = ReplyKeyboardMarkup(
     is_persistent=True,
     input_field_placeholder="Выберите действие",
 )
+KB_DONE = ReplyKeyboardMarkup([["Готово"]], resize_keyboard=True)
+KB_RESUME = ReplyKeyboardMarkup([["▶️ Продолжить", "🔄 Начать заново"]], resize_keyboard=True)
+KB_CONFIRM = ReplyKeyboardMarkup([["✅ Отправить", "❌ Отмена"], ["🔄 Начать заново"]], resize_keyboard=True)
 
 BTN_FILL_PROFILE_RE = re.compile(r"(?:✍️\ufe0f?\s*)?заполнить профиль$", re.IGNORECASE)
 BTN_NEW_CONSULT_RE = re.compile(r"(?:🆕\ufe0f?\s*)?начать новую консультацию$", re.IGNORECASE)
 BTN_MY_DATA_RE = re.compile(r"(?:ℹ️\ufe0f?\s*)?мои данные$", re.IGNORECASE)
+BTN_DONE_RE = re.compile(r"^Готово$")
+BTN_CONFIRM_RE = re.compile(r"^(?:✅ Отправить|❌ Отмена|🔄 Начать заново|▶️ Продолжить)$")
 
 STATE_COMPLAINTS, STATE_HISTORY, STATE_PLAN, STATE_FILES, STATE_CONFIRM = range(5)
 STATE_REG_NAME, STATE_REG_PHONE, STATE_REG_WORK = range(10, 13)
@@ -89,23 +101,21 @@ def build_summary_html(consult: dict, dentist: dict) -> str:
     )
 
 
+_HTML_TO_PLAIN = {"<b>": "", "</b>": "", '<a href="': "", '">': " ", "</a>": ""}
+_HTML_TO_PLAIN_RE = re.compile("|".join(map(re.escape, _HTML_TO_PLAIN)))
+
+
 def html_to_plain(html_text: str) -> str:
-    return (
-        html_text.replace("<b>", "")
-        .replace("</b>", "")
-        .replace('<a href="', "")
-        .replace('">', " ")
-        .replace("</a>", "")
-    )
+    return _HTML_TO_PLAIN_RE.sub(lambda m: _HTML_TO_PLAIN[m.group(0)], html_text)
 
 
 def short_caption(html_text: str) -> str:
-    CAPTION_LIMIT = 1024
     if len(html_text) <= CAPTION_LIMIT:
         return html_text
-    cut = html_text[: CAPTION_LIMIT - 20]
-    cut = cut.rsplit(" ", 1)[0]
-    return cut + " … (полный текст в 00_summary.txt)"
+    end = html_text.rfind(" ", 0, CAPTION_LIMIT - 20)
+    if end == -1:
+        end = CAPTION_LIMIT - 20
+    return html_text[:end] + " … (полный текст в 00_summary.txt)"
 
 
 def build_deeplink_keyboard(dentist: dict) -> Optional[InlineKeyboardMarkup]:
@@ -119,44 +129,64 @@ def build_deeplink_keyboard(dentist: dict) -> Optional[InlineKeyboardMarkup]:
     return InlineKeyboardMarkup([[InlineKeyboardButton("💬 Написать стоматологу", url=url)]])
 
 
+def _split_albums(items: List[dict]) -> List[List[dict]]:
+    size = MediaGroupLimit.MAX_MEDIA_LENGTH
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    # a lone leftover can't form an album, borrow one item from the previous chunk
+    if len(chunks) > 1 and len(chunks[-1]) == 1:
+        chunks[-1].insert(0, chunks[-2].pop())
+    return chunks
+
+
 async def _send_as_media_groups_with_caption(
     context: ContextTypes.DEFAULT_TYPE,
     chat_id: int,
-    caption_html: str,
+    caption_html: Optional[str],
     atts: List[dict],
     reply_markup: Optional[InlineKeyboardMarkup],
     dentist: dict,
 ):
-    batch: List[InputMediaPhoto | InputMediaDocument] = []
-    first_item_used = False
-
-    async def flush():
-        nonlocal batch
-        if not batch:
-            return
-        to_send = batch[:10]
-        del batch[:10]
-        await context.bot.send_media_group(chat_id=chat_id, media=to_send)
-
-    for a in atts:
-        if a["file_type"] == "photo":
-            if not first_item_used:
-                batch.append(InputMediaPhoto(media=a["file_id"], caption=caption_html, parse_mode=ParseMode.HTML))
-                first_item_used = True
-            else:
-                batch.append(InputMediaPhoto(media=a["file_id"]))
-        else:
-            if not first_item_used:
-                batch.append(InputMediaDocument(media=a["file_id"], caption=caption_html, parse_mode=ParseMode.HTML))
-                first_item_used = True
+    # Telegram albums hold 2-10 items and can't mix documents with photos, so each type gets its own albums
+    photos = [a for a in atts if a["file_type"] == "photo"]
+    docs = [a for a in atts if a["file_type"] != "photo"]
+    groups = _split_albums(photos) + _split_albums(docs)
+
+    async def send(items: List[dict], caption: Optional[str] = None):
+        is_photo = items[0]["file_type"] == "photo"
+        if len(items) == 1:
+            if is_photo:
+                await context.bot.send_photo(chat_id=chat_id, photo=items[0]["file_id"], caption=caption, parse_mode=ParseMode.HTML)
             else:
-                batch.append(InputMediaDocument(media=a["file_id"]))
-
-        if len(batch) == 10:
-            await flush()
-
-    if batch:
-        await flush()
+                await context.bot.send_document(chat_id=chat_id, document=items[0]["file_id"], caption=caption, parse_mode=ParseMode.HTML)
+            return
+        media_cls = InputMediaPhoto if is_photo else InputMediaDocument
+        media = [media_cls(media=a["file_id"]) for a in items]
+        if caption:
+            media[0] = media_cls(media=items[0]["file_id"], caption=caption, parse_mode=ParseMode.HTML)
+        await context.bot.send_media_group(chat_id=chat_id, media=media)
+
+    if groups:
+        # the captioned album goes first, the rest are sent concurrently within Telegram's rate limits
+        sem = asyncio.BoundedSemaphore(MEDIA_GROUP_CONCURRENCY)
+
+        async def send_limited(items: List[dict], caption: Optional[str] = None):
+            async with sem:
+                try:
+                    await send(items, caption)
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+                    await send(items, caption)
+
+        await send_limited(groups[0], caption_html)
+        # one failed album cancels the others instead of leaving them running unowned
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for items in groups[1:]:
+                    tg.create_task(send_limited(items))
+        except ExceptionGroup as eg:
+            # surface the Telegram error itself so callers' except clauses still match
+            raise eg.exceptions[0]
 
     if reply_markup:
         try:
@@ -174,40 +204,49 @@ async def _build_and_send_zip(
     caption_text = short_caption(html_text)
     kb = build_deeplink_keyboard(dentist)
 
-    total_size = 0
-    files_meta: List[Tuple[dict, object]] = []
-    for a in atts:
-        f = await context.bot.get_file(a["file_id"])
-        files_meta.append((a, f))
-        if getattr(f, "file_size", None):
-            total_size += f.file_size
+    # sizes come from the incoming updates, so no get_file round-trip is needed to decide
+    total_size = sum(a.get("file_size") or 0 for a in atts)
 
     if total_size > MAX_ZIP_MB * 1024 * 1024:
         await _send_as_media_groups_with_caption(context, chat_id, caption_text, atts, kb, dentist)
         return
 
-    with tempfile.TemporaryDirectory() as tmp:
-        summary_path = os.path.join(tmp, "00_summary.txt")
-        with open(summary_path, "w", encoding="utf-8") as out:
-            out.write(plain_text + "\n")
-
-        local_paths = [summary_path]
-        for i, (a, fobj) in enumerate(files_meta, 1):
-            ext = ".jpg" if a["file_type"] == "photo" else ".bin"
-            out_path = os.path.join(tmp, f"attachment_{i}{ext}")
-            await fobj.download_to_drive(out_path, read_timeout=120.0)
-            local_paths.append(out_path)
-
-        bio = BytesIO()
-        with zipfile.ZipFile(bio, "w", zipfile.ZIP_DEFLATED) as z:
-            for p in local_paths:
-                z.write(p, arcname=os.path.basename(p))
-        bio.seek(0)
+    with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_BYTES) as spool:
+        with zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("00_summary.txt", plain_text + "\n")
+
+            sem = asyncio.BoundedSemaphore(DOWNLOAD_CONCURRENCY)
+
+            async def _dl(i: int, a: dict):
+                async with sem:
+                    fobj = await context.bot.get_file(a["file_id"])
+                    data = await fobj.download_as_bytearray(read_timeout=120.0)
+                is_photo = a["file_type"] == "photo"
+                zinfo = zipfile.ZipInfo(f"attachment_{i}{'.jpg' if is_photo else '.bin'}", time.localtime()[:6])
+                # JPEG is already compressed, deflating it only burns CPU
+                zinfo.compress_type = zipfile.ZIP_STORED if is_photo else zipfile.ZIP_DEFLATED
+                # no await while the entry is open, so concurrent downloads never interleave writes
+                with z.open(zinfo, "w", force_zip64=True) as dst:
+                    dst.write(data)
+
+            # one failed download cancels the rest before the archive is closed under them
+            async with asyncio.TaskGroup() as tg:
+                for i, a in enumerate(atts, 1):
+                    tg.create_task(_dl(i, a))
+        # the spool rolls over to disk once it grows past max_size
+        on_disk = spool.tell() > ZIP_SPOOL_MAX_BYTES
+        spool.seek(0)
+        # httpx calls fileno() on file handles, which would force an in-memory spool to disk
+        document = (
+            InputFile(spool, filename="lor_consultation.zip", read_file_handle=False)
+            if on_disk
+            else InputFile(spool.read(), filename="lor_consultation.zip")
+        )
 
         try:
             await context.bot.send_document(
                 chat_id=chat_id,
-                document=InputFile(bio, filename="lor_consultation.zip"),
+                document=document,
                 caption=caption_text,
                 parse_mode=ParseMode.HTML,
                 read_timeout=120.0,
@@ -219,6 +258,35 @@ async def _build_and_send_zip(
 
 
 
+async def _send_consultation(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, consult: dict, dentist: dict, atts: List[dict]
+):
+    if SEND_ZIP:
+        await _build_and_send_zip(context, chat_id, consult, dentist, atts)
+        return
+
+    # attachments already live on Telegram's side, re-sending them by file_id needs no download/upload
+    html_text = build_summary_html(consult, dentist)
+    kb = build_deeplink_keyboard(dentist)
+    if atts and len(html_text) <= CAPTION_LIMIT:
+        await _send_as_media_groups_with_caption(context, chat_id, html_text, atts, kb, dentist)
+        return
+
+    # the full summary doesn't fit a caption (or there is nothing to attach it to)
+    if len(html_text) <= MessageLimit.MAX_TEXT_LENGTH:
+        await context.bot.send_message(chat_id=chat_id, text=html_text, parse_mode=ParseMode.HTML)
+    else:
+        # the answers have no length cap; ship the full text as a file, like the ZIP does
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=InputFile((html_to_plain(html_text) + "\n").encode("utf-8"), filename="00_summary.txt"),
+            caption=short_caption(html_text),
+            parse_mode=ParseMode.HTML,
+        )
+    await _send_as_media_groups_with_caption(context, chat_id, None, atts, kb, dentist)
+
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     await db.upsert_dentist(user.id, tg_username=user.username)
@@ -282,7 +350,7 @@ async def cb_view_consult(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"<b>Заявка #{c['id']}</b>\n"
         f"Статус: {c.get('status','—')}\n"
         f"Создана: {c.get('created_at','—')}\n\n"
-        "Детали анкеты сохраняются в черновике до отправки; архив содержит полный текст и файлы."
+        "Детали анкеты сохраняются в черновике до отправки; полный текст и файлы отправлены в чат ЛОР-врача."
     )
     await query.edit_message_text(txt, parse_mode=ParseMode.HTML)
 
@@ -315,6 +383,36 @@ async def reg_work(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def _flush_draft(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    if context.user_data.pop("_draft_dirty", False):
+        await db.save_draft(user_id, context.user_data["consult"], context.user_data["attachments"])
+
+
+async def _flush_draft_later(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    await asyncio.sleep(DRAFT_FLUSH_DELAY)
+    # past this point the save must not be cancelled by a newer edit
+    context.user_data.pop("_draft_flush_task", None)
+    await _flush_draft(context, user_id)
+
+
+def _cancel_draft_flush(context: ContextTypes.DEFAULT_TYPE):
+    task = context.user_data.pop("_draft_flush_task", None)
+    if task and not task.done():
+        task.cancel()
+
+
+def _mark_draft_dirty(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Debounce draft writes: save once the user pauses instead of on every message."""
+    context.user_data["_draft_dirty"] = True
+    _cancel_draft_flush(context)
+    context.user_data["_draft_flush_task"] = context.application.create_task(_flush_draft_later(context, user_id))
+
+
+def _drop_draft_changes(context: ContextTypes.DEFAULT_TYPE):
+    _cancel_draft_flush(context)
+    context.user_data.pop("_draft_dirty", None)
+
+
 async def new_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     consult, atts = await db.load_draft(user.id)
@@ -323,7 +421,7 @@ async def new_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["attachments"] = atts
         await update.message.reply_text(
             "У вас есть незавершённая консультация. Хотите продолжить?",
-            reply_markup=ReplyKeyboardMarkup([["▶️ Продолжить", "🔄 Начать заново"]], resize_keyboard=True),
+            reply_markup=KB_RESUME,
         )
         return STATE_CONFIRM
 
@@ -335,42 +433,44 @@ async def new_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def new_complaints(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["consult"]["patient_complaints"] = update.message.text.strip()
-    await db.save_draft(update.effective_user.id, context.user_data["consult"], context.user_data["attachments"])
+    _mark_draft_dirty(context, update.effective_user.id)
     await update.message.reply_text("2/4. Анамнез / сопутствующие данные (кратко):")
     return STATE_HISTORY
 
 
 async def new_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["consult"]["patient_history"] = update.message.text.strip()
-    await db.save_draft(update.effective_user.id, context.user_data["consult"], context.user_data["attachments"])
+    _mark_draft_dirty(context, update.effective_user.id)
     await update.message.reply_text("3/4. Планируемая стоматологическая работа:")
     return STATE_PLAN
 
 
 async def new_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["consult"]["planned_work"] = update.message.text.strip()
-    await db.save_draft(update.effective_user.id, context.user_data["consult"], context.user_data["attachments"])
+    _mark_draft_dirty(context, update.effective_user.id)
     await update.message.reply_text(
         "4/4. Прикрепите снимки/файлы (можно несколько, до 40 Мб). Когда закончите — нажмите «Готово».",
-        reply_markup=ReplyKeyboardMarkup([["Готово"]], resize_keyboard=True),
+        reply_markup=KB_DONE,
     )
     return STATE_FILES
 
 
 async def new_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message and update.message.photo:
-        file_id = update.message.photo[-1].file_id
-        context.user_data["attachments"].append({"file_id": file_id, "file_type": "photo"})
+        photo = update.message.photo[-1]
+        context.user_data["attachments"].append({"file_id": photo.file_id, "file_type": "photo", "file_size": photo.file_size})
     elif update.message and update.message.document:
         doc = update.message.document
-        context.user_data["attachments"].append({"file_id": doc.file_id, "file_type": "document"})
-    await db.save_draft(update.effective_user.id, context.user_data["consult"], context.user_data["attachments"])
-    await update.message.reply_text("Файл добавлен. Прикрепите ещё или нажмите «Готово».", reply_markup=ReplyKeyboardMarkup([["Готово"]], resize_keyboard=True))
+        context.user_data["attachments"].append({"file_id": doc.file_id, "file_type": "document", "file_size": doc.file_size})
+    _mark_draft_dirty(context, update.effective_user.id)
+    await update.message.reply_text("Файл добавлен. Прикрепите ещё или нажмите «Готово».", reply_markup=KB_DONE)
     return STATE_FILES
 
 
 async def new_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
+    _cancel_draft_flush(context)
+    await _flush_draft(context, user.id)
     consult = context.user_data["consult"]
     dentist = await db.get_dentist_by_tg_id(user.id)
     dentist.setdefault("tg_id", user.id)
@@ -380,11 +480,17 @@ async def new_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         preview,
         parse_mode=ParseMode.HTML,
-        reply_markup=ReplyKeyboardMarkup([["✅ Отправить", "❌ Отмена"], ["🔄 Начать заново"]], resize_keyboard=True),
+        reply_markup=KB_CONFIRM,
     )
     return STATE_CONFIRM
 
 
+async def new_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _cancel_draft_flush(context)
+    await _flush_draft(context, update.effective_user.id)
+    return ConversationHandler.END
+
+
 async def new_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     choice = update.message.text
     user = update.effective_user
@@ -394,18 +500,28 @@ async def new_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     atts = context.user_data.get("attachments", [])
 
     if choice.startswith("✅"):
-        await _build_and_send_zip(context, LOR_TARGET_CHAT_ID, consult, dentist, atts)
+        try:
+            await _send_consultation(context, LOR_TARGET_CHAT_ID, consult, dentist, atts)
+        except BadRequest as e:
+            log.warning(f"Consultation from {user.id} not sent: {e}")
+            await update.message.reply_text(
+                "⚠️ Не удалось отправить заявку. Попробуйте ещё раз или отмените.", reply_markup=KB_CONFIRM
+            )
+            return STATE_CONFIRM
         await db.insert_consultation_log(user.id, status="sent")
+        _drop_draft_changes(context)
         await db.clear_draft(user.id)
         await update.message.reply_text("✅ Заявка отправлена ЛОР-врачу.", reply_markup=MAIN_KB)
         return ConversationHandler.END
 
     if choice.startswith("❌"):
+        _drop_draft_changes(context)
         await db.clear_draft(user.id)
         await update.message.reply_text("❌ Отменено.", reply_markup=MAIN_KB)
         return ConversationHandler.END
 
     if choice.startswith("🔄"):
+        _drop_draft_changes(context)
         await db.clear_draft(user.id)
         context.user_data["consult"] = {}
         context.user_data["attachments"] = []
@@ -435,6 +551,8 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def safe_post_init(application):
+    await db.init_db()
+
     async def safe_call(coro, label):
         try:
             return await coro
@@ -471,9 +589,30 @@ async def safe_post_init(application):
     )
 
 
+async def on_shutdown(application):
+    await db.close_db()
+
+
 def build_application():
-    request = HTTPXRequest(connect_timeout=10.0, read_timeout=120.0, write_timeout=120.0, pool_timeout=10.0)
-    app = ApplicationBuilder().token(BOT_TOKEN).request(request).post_init(safe_post_init).build()
+    request = HTTPXRequest(
+        connection_pool_size=64,
+        connect_timeout=10.0,
+        read_timeout=120.0,
+        write_timeout=120.0,
+        pool_timeout=10.0,
+        http_version="1.1",
+    )
+    # getUpdates already has its own single-connection pool in PTB; only its timeouts are tuned here
+    updates_request = HTTPXRequest(connection_pool_size=1, connect_timeout=10.0, read_timeout=30.0, pool_timeout=10.0)
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .get_updates_request(updates_request)
+        .post_init(safe_post_init)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_error_handler(on_error)
 
@@ -500,16 +639,11 @@ def build_application():
             STATE_PLAN: [MessageHandler(filters.TEXT & ~filters.COMMAND, new_plan)],
             STATE_FILES: [
                 MessageHandler(filters.PHOTO | filters.Document.ALL, new_files),
-                MessageHandler(filters.Regex("^Готово$"), new_done),
-            ],
-            STATE_CONFIRM: [
-                MessageHandler(filters.Regex("^✅ Отправить$"), new_confirm),
-                MessageHandler(filters.Regex("^❌ Отмена$"), new_confirm),
-                MessageHandler(filters.Regex("^🔄 Начать заново$"), new_confirm),
-                MessageHandler(filters.Regex("^▶️ Продолжить$"), new_confirm),
+                MessageHandler(filters.Regex(BTN_DONE_RE), new_done),
             ],
+            STATE_CONFIRM: [MessageHandler(filters.Regex(BTN_CONFIRM_RE), new_confirm)],
         },
-        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
+        fallbacks=[CommandHandler("cancel", new_cancel)],
     )
     app.add_handler(consult_conv)
 
@@ -520,7 +654,6 @@ def build_application():
 
 
 def main():
-    asyncio.run(db.init_db())
     app = build_application()
     log.info("Запуск long polling...")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
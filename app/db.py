@@ -1,5 +1,6 @@
 import json
 import os
+import asyncio
 import aiosqlite
 from typing import Tuple, List, Dict, Any, Optional
 
@@ -10,63 +11,92 @@ DB_PATH = os.getenv("DB_PATH", os.path.join(_data_dir, "bot.db"))
 DRAFT_PK_COL = "dentist_tg_id"
 CONS_PK_COL  = "dentist_tg_id"
 
+# One connection for the whole process; opened in init_db(), closed in close_db()
+_db: Optional[aiosqlite.Connection] = None
+_write_lock = asyncio.Lock()
+
+# Last persisted draft per dentist, so resuming doesn't hit sqlite and re-parse the JSON
+_draft_cache: Dict[int, Tuple[Dict[str, Any], List[Dict[str, Any]]]] = {}
+
+
+_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-20000;
+"""
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS dentists (
+        tg_id       INTEGER PRIMARY KEY,
+        full_name   TEXT,
+        phone       TEXT,
+        workplace   TEXT,
+        tg_username TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS consultations (
+        id            INTEGER PRIMARY KEY AUTOINCREMENT,
+        dentist_tg_id INTEGER,
+        status        TEXT,
+        created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS consultations_draft (
+        dentist_tg_id INTEGER PRIMARY KEY,
+        complaints    TEXT,
+        history       TEXT,
+        plan          TEXT,
+        attachments   TEXT
+    );
+"""
+
 
 async def init_db():
-    global DRAFT_PK_COL, CONS_PK_COL
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS dentists (
-                tg_id       INTEGER PRIMARY KEY,
-                full_name   TEXT,
-                phone       TEXT,
-                workplace   TEXT,
-                tg_username TEXT
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS consultations (
-                id            INTEGER PRIMARY KEY AUTOINCREMENT,
-                dentist_tg_id INTEGER,
-                status        TEXT,
-                created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS consultations_draft (
-                dentist_tg_id INTEGER PRIMARY KEY,
-                complaints    TEXT,
-                history       TEXT,
-                plan          TEXT,
-                attachments   TEXT
-            )
-        """)
-        await db.commit()
-
-        cons_cols  = await _table_columns(db, "consultations")
-        draft_cols = await _table_columns(db, "consultations_draft")
+    global DRAFT_PK_COL, CONS_PK_COL, _db
+
+    if _db is None:
+        _db = await aiosqlite.connect(DB_PATH)
+        _db.row_factory = aiosqlite.Row
+        await _db.executescript(_PRAGMAS)
+
+    db = _db
+    async with _write_lock:
+        await db.executescript(_SCHEMA)
+
+        cons_cols    = await _table_columns(db, "consultations")
+        draft_cols   = await _table_columns(db, "consultations_draft")
+        dentist_cols = await _table_columns(db, "dentists")
 
         CONS_PK_COL  = "dentist_tg_id" if "dentist_tg_id" in cons_cols else (
                        "dentist_id"    if "dentist_id"    in cons_cols else "dentist_tg_id")
         DRAFT_PK_COL = "dentist_tg_id" if "dentist_tg_id" in draft_cols else (
                        "dentist_id"    if "dentist_id"    in draft_cols else "dentist_tg_id")
 
-        await _ensure_columns(db, "consultations_draft", {
+        # missing columns and the index go out as one script instead of one round-trip each
+        script = _missing_columns_sql("consultations_draft", draft_cols, {
             "complaints":  "TEXT",
             "history":     "TEXT",
             "plan":        "TEXT",
             "attachments": "TEXT",
         })
-        await _ensure_columns(db, "dentists", {
+        script += _missing_columns_sql("dentists", dentist_cols, {
             "full_name":   "TEXT",
             "phone":       "TEXT",
             "workplace":   "TEXT",
             "tg_username": "TEXT",
         })
+        script.append(f"CREATE INDEX IF NOT EXISTS idx_consult_dentist ON consultations({CONS_PK_COL}, id DESC);")
+
+        await db.executescript("\n".join(script))
+
 
-        await db.commit()
+async def close_db():
+    global _db
+    if _db is not None:
+        await _db.close()
+        _db = None
 
 
 async def _table_columns(db: aiosqlite.Connection, table: str) -> List[str]:
@@ -75,11 +105,8 @@ async def _table_columns(db: aiosqlite.Connection, table: str) -> List[str]:
     await cur.close()
     return [r[1] for r in rows]
 
-async def _ensure_columns(db: aiosqlite.Connection, table: str, expected: Dict[str, str]):
-    have = set(await _table_columns(db, table))
-    for name, typ in expected.items():
-        if name not in have:
-            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {typ}")
+def _missing_columns_sql(table: str, have: List[str], expected: Dict[str, str]) -> List[str]:
+    return [f"ALTER TABLE {table} ADD COLUMN {name} {typ};" for name, typ in expected.items() if name not in have]
 
 
 async def upsert_dentist(
@@ -89,15 +116,15 @@ async def upsert_dentist(
     workplace: Optional[str] = None,
     tg_username: Optional[str] = None,
 ):
-    row = await _fetchone("SELECT * FROM dentists WHERE tg_id = ?", (tg_id,))
-    row = dict(row) if row else {}
-    if full_name   is not None: row["full_name"]   = full_name
-    if phone       is not None: row["phone"]       = phone
-    if workplace   is not None: row["workplace"]   = workplace
-    if tg_username is not None: row["tg_username"] = tg_username
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with _write_lock:
+        row = await _fetchone("SELECT * FROM dentists WHERE tg_id = ?", (tg_id,))
+        row = dict(row) if row else {}
+        if full_name   is not None: row["full_name"]   = full_name
+        if phone       is not None: row["phone"]       = phone
+        if workplace   is not None: row["workplace"]   = workplace
+        if tg_username is not None: row["tg_username"] = tg_username
+
+        await _db.execute(
             """
             INSERT INTO dentists (tg_id, full_name, phone, workplace, tg_username)
             VALUES (?, ?, ?, ?, ?)
@@ -110,7 +137,7 @@ async def upsert_dentist(
             (tg_id, row.get("full_name"), row.get("phone"),
                    row.get("workplace"), row.get("tg_username")),
         )
-        await db.commit()
+        await _db.commit()
 
 async def get_dentist_by_tg_id(tg_id: int) -> Dict[str, Any]:
     row = await _fetchone("SELECT * FROM dentists WHERE tg_id = ?", (tg_id,))
@@ -125,8 +152,8 @@ async def save_draft(dentist_tg_id: int, consult: Dict[str, Any], attachments: L
     plan       = consult.get("planned_work")
     attachments_json = json.dumps(attachments, ensure_ascii=False)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with _write_lock:
+        await _db.execute(
             f"""
             INSERT INTO consultations_draft ({DRAFT_PK_COL}, complaints, history, plan, attachments)
             VALUES (?, ?, ?, ?, ?)
@@ -138,9 +165,18 @@ async def save_draft(dentist_tg_id: int, consult: Dict[str, Any], attachments: L
             """,
             (dentist_tg_id, complaints, history, plan, attachments_json),
         )
-        await db.commit()
+        await _db.commit()
+        _draft_cache[dentist_tg_id] = (
+            {"patient_complaints": complaints, "patient_history": history, "planned_work": plan},
+            list(attachments),
+        )
 
 async def load_draft(dentist_tg_id: int) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    cached = _draft_cache.get(dentist_tg_id)
+    if cached:
+        consult, atts = cached
+        return dict(consult), list(atts)
+
     row = await _fetchone(
         f"SELECT complaints, history, plan, attachments FROM consultations_draft WHERE {DRAFT_PK_COL} = ?",
         (dentist_tg_id,),
@@ -153,21 +189,23 @@ async def load_draft(dentist_tg_id: int) -> Tuple[Dict[str, Any], List[Dict[str,
         "planned_work":       row["plan"],
     }
     atts = json.loads(row["attachments"] or "[]")
-    return consult, atts
+    _draft_cache[dentist_tg_id] = (consult, atts)
+    return dict(consult), list(atts)
 
 async def clear_draft(dentist_tg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(f"DELETE FROM consultations_draft WHERE {DRAFT_PK_COL} = ?", (dentist_tg_id,))
-        await db.commit()
+    async with _write_lock:
+        await _db.execute(f"DELETE FROM consultations_draft WHERE {DRAFT_PK_COL} = ?", (dentist_tg_id,))
+        await _db.commit()
+        _draft_cache.pop(dentist_tg_id, None)
 
 
 async def insert_consultation_log(dentist_tg_id: int, status: str = "sent"):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with _write_lock:
+        await _db.execute(
             f"INSERT INTO consultations ({CONS_PK_COL}, status) VALUES (?, ?)",
             (dentist_tg_id, status),
         )
-        await db.commit()
+        await _db.commit()
 
 async def list_consultations_by_dentist(dentist_tg_id: int) -> List[Dict[str, Any]]:
     rows = await _fetchall(
@@ -187,17 +225,13 @@ get_consultation = get_consultation_by_id
 
 
 async def _fetchone(query: str, params: tuple = ()) -> Optional[aiosqlite.Row]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute(query, params)
-        row = await cur.fetchone()
-        await cur.close()
-        return row
+    cur = await _db.execute(query, params)
+    row = await cur.fetchone()
+    await cur.close()
+    return row
 
 async def _fetchall(query: str, params: tuple = ()) -> List[aiosqlite.Row]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute(query, params)
-        rows = await cur.fetchall()
-        await cur.close()
-        return rows
+    cur = await _db.execute(query, params)
+    rows = await cur.fetchall()
+    await cur.close()
+    return rows